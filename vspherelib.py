@@ -11,27 +11,29 @@ from __future__ import print_function
 
 import argparse
 import getpass
+import io
 import os
 import sys
-import OpenSSL
 import socket
 import ssl
 import re
 import time
 import atexit
+import concurrent.futures
 import functools
+import math
 import threading
 import random
+import shlex
 import weakref
 
 from fnmatch    import translate as glob2regex
+from itertools  import chain
+from operator   import attrgetter
 
 from pyVim      import connect as pyVconnect
 from pyVmomi    import vim, vmodl, VmomiSupport
 
-import requests
-requests.packages.urllib3.disable_warnings()
-
 try:
     long
 except NameError:  # python3
@@ -46,6 +48,24 @@ progname = os.path.basename( sys.argv[0] )
 timestring_format = None
 
 
+def _requests():
+    # requests is only used for guest file transfers, so don't pay for
+    # loading it in every command.
+    import requests
+    requests.packages.urllib3.disable_warnings()
+    return requests
+
+
+# One context is shared by every connection, so that it (and the default
+# certificate store it loads) is only set up once per process.
+@functools.lru_cache( maxsize=None )
+def _ssl_context():
+    try:
+        return ssl._create_unverified_context()
+    except AttributeError:
+        return None
+
+
 def _enablep( arg=None ):
     # n.b. '' returns True because an ennvar set but empty means enable.
     # Either the variable should not in the environment at all, or it
@@ -57,6 +77,14 @@ def _enablep( arg=None ):
 debug     = _enablep( os.getenv( 'VSPHERELIB_DEBUG'     ) )
 debug_rpc = _enablep( os.getenv( 'VSPHERELIB_DEBUG_RPC' ) )
 
+# Whether connections reuse container views by default, for scripts
+# which don't pass reuseViews themselves.
+reuse_views = _enablep( os.getenv( 'VSPHERELIB_REUSE_VIEWS' ) )
+
+# Seconds a reused container view is kept before it is recreated.
+# 0 means views are kept for the life of the connection.
+view_ttl  = float( os.getenv( 'VSPHERELIB_VIEW_TTL' ) or 600 )
+
 
 
 POSIX = object()  # posix system, e.g. unix or osx
@@ -107,7 +135,7 @@ def with_conditional_stacktrace( *exceptions ):
         class conditional_stacktrace_wrapper( wrapped_class ):
             def __init__( self, *args, **kwargs ):
                 sys.excepthook = excepthook
-                self.reason = str.join( ': ', (str( s ) for s in args) )
+                self.reason = ': '.join( str( s ) for s in args )
             def __str__( self ):
                 return self.reason
         conditional_stacktrace_wrapper.__name__ = wrapped_class.__name__
@@ -166,10 +194,13 @@ class _with( object ):
             pass
 
 class _super( object ):
+    __slots__ = ()
     super = property( lambda self: super( type( self ), self ) )
 
 
 class Diag( object ):
+    __slots__ = ( 'sep', 'lines' )
+
     def __init__( self, *args, **kwargs ):
         self.sep    = kwargs.get( 'sep',  ': ' )
         self.lines  = []
@@ -178,7 +209,7 @@ class Diag( object ):
     def __str__( self ):
         if not self.lines:
             return ''
-        return str.join( '\n', self.lines )
+        return '\n'.join( self.lines )
 
     def append( self, *args ):
         if args:
@@ -241,6 +272,10 @@ class pseudoPropAttr( dict, _super ):
     # can have direct values as well as one being a parent of the other.
     # Also, we keep track of the original vim object types for class testing.
 
+    # These are the only instance attributes.  Deep conversions create a
+    # node for every nested data object, so don't give each one a __dict__.
+    __slots__ = ( '_moId', '_vimobj', '_vimtype' )
+
     class pseudoPropList( list ): # allows us to add attributes
         def __init__( self, initial=None, **kwargs ):
             if initial:
@@ -342,13 +377,33 @@ class pseudoPropAttr( dict, _super ):
 
 
     # replace dict.x with self.super.x if pedantic
-    def _keys( self ):                 return dict.keys( self )
-    def _delattr( self, name ):        return dict.__delattr__( self, name )
-    def _getattr( self, name ):        return dict.__getattribute__( self, name )
-    def _setattr( self, name, value ): return dict.__setattr__( self, name, value )
-    def _delitem( self, name ):        return dict.__delitem__( self, name )
-    def _getitem( self, name ):        return dict.__getitem__( self, name )
-    def _setitem( self, name, value ): return dict.__setitem__( self, name, value )
+    # These are bound directly rather than wrapped in a def, which would
+    # add a python call frame to every item and attribute access.
+    _keys    = dict.keys
+    _delattr = dict.__delattr__
+    _getattr = dict.__getattribute__
+    _setattr = dict.__setattr__
+    _delitem = dict.__delitem__
+    _get     = dict.get
+    _getitem = dict.__getitem__
+    _setitem = dict.__setitem__
+
+    # copy and pickle restore slot state with setattr, which would store
+    # the slots as dictionary keys via our __setattr__.
+    def __getstate__( self ):
+        state = {}
+        for name in self.__slots__:
+            try:
+                state[ name ] = self._getattr( name )
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__( self, state ):
+        if isinstance( state, tuple ): # ( __dict__, slots ) form
+            state = state[ 1 ]
+        for name in state or ():
+            self._setattr( name, state[ name ] )
 
     def _tail( self, key, afap=False ):
         try:
@@ -359,12 +414,14 @@ class pseudoPropAttr( dict, _super ):
         prev = walk = self
         stopat = 1 if afap else 0
         while len( seq ) > stopat:
+            # Probe with a sentinel rather than catching KeyError; new keys
+            # miss here on every assignment.
             try:
-                obj = walk._getitem( seq[ 0 ] )
+                obj = walk._get( seq[ 0 ], Undef )
             except TypeError:
                 if afap: return prev, seq
                 else:    raise KeyError( key )
-            except KeyError:
+            if obj is Undef:
                 if afap: return walk, seq
                 else:    raise KeyError( key )
             if afap and not isinstance( obj, type( self ) ):
@@ -460,20 +517,16 @@ class pseudoPropAttr( dict, _super ):
                 new._setitem( None, orig )
             tail._setitem( rest.pop( 0 ), new )
             tail = new
-        try:
-            last = tail._getitem( rest[ 0 ] )
-
-            if isinstance( last, stype ):
-                if isinstance( val, stype):
-                    # Save previous direct value if no new one
-                    if None in last and None not in val:
-                        val._setitem( None, last[ None ] )
-                    tail._setitem( rest[ 0 ], val )
-                else:
-                    last._setitem( None, val )
-            else:
+        last = tail._get( rest[ 0 ], Undef )
+        if isinstance( last, stype ):
+            if isinstance( val, stype):
+                # Save previous direct value if no new one
+                if None in last and None not in val:
+                    val._setitem( None, last[ None ] )
                 tail._setitem( rest[ 0 ], val )
-        except KeyError:
+            else:
+                last._setitem( None, val )
+        else:
             tail._setitem( rest[ 0 ], val )
         return val
 
@@ -560,32 +613,33 @@ class pseudoPropAttr( dict, _super ):
 
 
 class Timer( object ):
+    __slots__ = ( 'label', 'beg_cl', 'beg_tm' )
+
     enabled  = _enablep( os.getenv( 'VSPHERELIB_TIMER' ))
     acc_tm   = 0
     acc_cl   = 0
     fmt      = '{0:<40}: {1: > 8.4f}s / {2:> 8.4f}s'
     fh       = sys.stderr
 
-    def __init__( self, label ):
-        self.label = label
-        self.beg_cl = self.process_time()
-        self.beg_tm = self.perf_counter()
-
     # n.b. python 3.8 removes time.clock entirely.
-    def process_time( self ):
-        try:
-            return time.process_time()
-        except AttributeError:
-            return time.clock()  # pre-3.3
+    try:
+        process_time = staticmethod( time.process_time )
+        perf_counter = staticmethod( time.perf_counter )
+    except AttributeError:  # pre-3.3
+        process_time = staticmethod( time.clock )
+        perf_counter = staticmethod( time.time )
 
-    def perf_counter( self ):
-        try:
-            return time.perf_counter()
-        except AttributeError:
-            return time.time()   # pre-3.3
+    def __init__( self, label ):
+        self.label = label
+        # Don't bother reading the clocks if nothing will be reported.
+        if self.enabled:
+            self.beg_cl = self.process_time()
+            self.beg_tm = self.perf_counter()
+        else:
+            self.beg_cl = self.beg_tm = None
 
     def report( self ):
-        if not self.enabled: return
+        if not self.enabled or self.beg_tm is None: return
         tot_tm = self.perf_counter() - self.beg_tm
         tot_cl = self.process_time() - self.beg_cl
         self.__class__.acc_tm += tot_tm
@@ -671,9 +725,7 @@ class ArgumentParser( argparse.ArgumentParser, _super, _with ):
         _environ = dict( globals() )
         _environ.update( locals() )
         def source( filename ):
-            script = file_contents( filename )
-            script.replace( '\r\n', '\n' )
-            exec( script, _environ, _environ )
+            exec( compile_file_cached( filename ), _environ, _environ )
 
         env_rc = os.getenv( 'VSPHERELIBRC' )
         if env_rc:
@@ -786,6 +838,8 @@ class ArgumentParser( argparse.ArgumentParser, _super, _with ):
 ######
 
 class propList( object ):
+    __slots__ = ( 'proplist', 'propset', 'propdict' )
+
     def __new__( self, *args ):
         '''If first param is already an instance, just return previous instance'''
         # n.b. in __new__, self is a class, not an instance
@@ -798,6 +852,7 @@ class propList( object ):
         if type( args[0] ) is propList:
             return
         self.proplist = []
+        self.propset  = set() # for membership tests; proplist keeps order
         self.propdict = {}
         self.add_if_new( *args )
 
@@ -821,7 +876,8 @@ class propList( object ):
                 self.add_if_new( *elt.keys() )
             elif type( elt ) in (tuple, list):
                 self.add_if_new( *elt )
-            elif elt not in self.proplist:
+            elif elt not in self.propset:
+                self.propset.add( elt )
                 self.proplist.append( elt )
 
     def names( self ):
@@ -915,7 +971,8 @@ class Cache( object ):
 
 class _vmomiCollect( object ):
     def create_filter_spec( self, vimtype, container, props ):
-        props    = propList( props or [] )
+        if not isinstance( props, propList ):
+            props = propList( props or [] )
 
         vpc      = vmodl.query.PropertyCollector
         travSpec = vpc.TraversalSpec( name = 'traverseEntities',
@@ -930,7 +987,17 @@ class _vmomiCollect( object ):
         return vpc.FilterSpec( objectSet=[ objSpec ], propSet=propSet )
 
     def create_container_view( self, vimtype, root=None, recursive=True ):
-        if root is None:
+        '''
+        ROOT may be a managed object, or the inventory path of a folder or
+        datacenter, e.g. "/dc1/vm/prod".  Rooting the view at the subtree
+        of interest keeps the server from traversing unrelated folders.
+        '''
+        if isinstance( root, (str, unicode) ) and root.rstrip( '/' ):
+            folder = self.path_to_folder_map( root.rstrip( '/' ))
+            if folder is None:
+                raise NameNotFoundError( root, 'folder not found' )
+            root = folder
+        elif root is None or isinstance( root, (str, unicode) ):
             root = self.si_content.rootFolder
         return self.si_content.viewManager.CreateContainerView(
             container = root,
@@ -945,6 +1012,100 @@ class _vmomiCollect( object ):
                 pass
         return self.si_content.viewManager.CreateListView( obj=objs )
 
+    # Maximum number of objects returned per property collector page.
+    # None lets the server choose, which keeps round trips to a minimum.
+    retrieve_max_objects = None
+
+    # See vmomiConnect.__init__
+    reuse_views  = False
+    _views       = {}
+    _filterspecs = {}
+
+    def retrieve_properties( self, filterSpec ):
+        '''
+        Generator yielding ObjectContent results for filterSpec, which may
+        also be a list of filter specs to be collected in the same request.
+
+        Results are fetched from the server in pages, of at most
+        `retrieve_max_objects' objects if that is set.
+        '''
+        specSet = filterSpec if isinstance( filterSpec, list ) else [ filterSpec ]
+        spc  = self.si_content.propertyCollector
+        opts = vmodl.query.PropertyCollector.RetrieveOptions(
+            maxObjects = self.retrieve_max_objects )
+        try:
+            res = spc.RetrievePropertiesEx( specSet, opts )
+        except vmodl.fault.MethodNotFound:
+            # ESXi 4.0 and earlier have no paged interface.
+            for obj in spc.RetrieveProperties( specSet ):
+                yield obj
+            return
+
+        while res:
+            for obj in res.objects:
+                yield obj
+            if not res.token:
+                break
+            res = spc.ContinueRetrievePropertiesEx( res.token )
+
+    def _get_container( self, vimtype, root=None, recursive=True ):
+        '''
+        Return a view to collect from and whether the caller should
+        destroy it when done.
+        '''
+        if isinstance( root, ( vim.view.ListView, vim.view.ContainerView )):
+            return root, False
+        elif isinstance( root, list ):
+            return self.create_list_view( root ), True
+        elif not self.reuse_views:
+            return self.create_container_view( vimtype, root, recursive ), True
+
+        # Container views are kept current by the server as the inventory
+        # changes, so they can be reused for the life of the session,
+        # or until view_ttl expires.
+        key = ( tuple( sorted( v._wsdlName for v in vimtype )),
+                getattr( root, '_moId', root ),
+                bool( recursive ) )
+        try:
+            view, expires = self._views[ key ]
+            if not expires or time.monotonic() < expires:
+                return view, False
+            self._destroy_view( key )
+        except KeyError:
+            pass
+        view    = self.create_container_view( vimtype, root, recursive )
+        expires = view_ttl and time.monotonic() + view_ttl
+        self._views[ key ] = ( view, expires )
+        return view, False
+
+    def _destroy_view( self, key ):
+        view, _ = self._views.pop( key )
+        for fkey in [ k for k in self._filterspecs if k[ 0 ] == view ]:
+            del self._filterspecs[ fkey ]
+        try:
+            view.Destroy()
+        except vmodl.MethodFault:
+            pass
+
+    def _forget_view( self, view ):
+        '''Drop VIEW if it is a reused view; return whether it was.'''
+        for key, ( elt, _ ) in list( self._views.items() ):
+            if elt is view:
+                self._destroy_view( key )
+                return True
+        return False
+
+    def invalidate_views( self, vimtype=None ):
+        '''
+        Destroy reused container views which include any of the types in
+        VIMTYPE, or all of them if VIMTYPE is not specified.
+        '''
+        names = vimtype and { v._wsdlName for v in vimtype }
+        for key in list( self._views ):
+            if names and not names.intersection( key[ 0 ] ):
+                continue
+            self._destroy_view( key )
+
     def _get_obj_props_nofilter( self, vimtype,
                                  props = None,
                                  root = None,
@@ -958,27 +1119,40 @@ class _vmomiCollect( object ):
         or vim.ManagedObject[] if there are no properties to collect.
         '''
 
-        gc_container = False
-        if isinstance( root, ( vim.view.ListView, vim.view.ContainerView )):
-            container = root
-        elif type( root ) is list:
-            container    = self.create_list_view( root )
-            gc_container = True
-        else:
-            container    = self.create_container_view( vimtype, root, recursive )
-            gc_container = True
-
+        for retry in ( True, False ):
+            container, gc_container = self._get_container( vimtype, root, recursive )
+            try:
+                return self._collect_container( container, gc_container, vimtype, props,
+                                                root, ignoreInvalidProps )
+            except vmodl.fault.ManagedObjectNotFound:
+                # Reused views belong to the session that created them, and
+                # are gone once the stub has transparently logged in again.
+                if not ( retry and self._forget_view( container )):
+                    raise
+
+    def _collect_container( self, container, gc_container, vimtype, props,
+                            root, ignoreInvalidProps ):
         if props is None:
             result = container.view
         else:
-            props      = propList( props )
-            spc        = self.si_content.propertyCollector
-            filterSpec = self.create_filter_spec( vimtype, container, props )
+            if not isinstance( props, propList ):
+                props  = propList( props )
+            # A filter spec over a reused view can be reused too.
+            fkey = None
+            if not gc_container and container is not root:
+                fkey = ( container, tuple( v._wsdlName for v in vimtype ),
+                         tuple( props.names() ))
+            try:
+                filterSpec = self._filterspecs[ fkey ]
+            except KeyError:
+                filterSpec = self.create_filter_spec( vimtype, container, props )
+                if fkey:
+                    self._filterspecs[ fkey ] = filterSpec
 
             timer  = Timer( lambda: 'retrieve {} '.format( ', '.join( v._wsdlName for v in vimtype )))
             while True:
                 try:
-                    result = spc.RetrieveProperties( [ filterSpec ] )
+                    result = list( self.retrieve_properties( filterSpec ))
                     break
                 except vmodl.query.InvalidProperty as e:
                     if not ignoreInvalidProps:
@@ -989,6 +1163,8 @@ class _vmomiCollect( object ):
                     # object types in the filterspec.
                     for propSet in filterSpec.propSet:
                         propSet.pathSet.remove( e.name )
+                    # Don't let the trimmed spec stand in for the original.
+                    self._filterspecs.pop( fkey, None )
                     if debug:
                         printerr( 'warning', e.name, 'invalid property path' )
             timer.report()
@@ -997,7 +1173,10 @@ class _vmomiCollect( object ):
             container.Destroy()
         return result
 
-    def get_obj_props( self, vimtype, props=None, root=None, recursive=True, mustMatchAll=True, ignoreInvalidProps=False ):
+    # See get_obj_props
+    single_pass_max_objects = 50
+
+    def get_obj_props( self, vimtype, props=None, root=None, recursive=True, mustMatchAll=True, ignoreInvalidProps=False, singlePass=None, nameCache=False ):
         '''
         If any of the properties have matching values to search for, narrow down
         the view of managed objects to retrieve the full list of attributes from.
@@ -1007,6 +1186,16 @@ class _vmomiCollect( object ):
         faster to create a new container with just that machine in it
         before then collecting a dozen properties from it.
 
+        If the set of candidate objects is known to be small, `singlePass=True'
+        collects all the properties at once and filters them locally instead,
+        saving a round trip to the server.  By default this is done when ROOT
+        is a list of fewer than `single_pass_max_objects' objects.
+
+        If the only filter is on `name', `nameCache=True' selects the objects
+        from the cached name map instead of asking the server.  This is
+        faster, but objects created or renamed since the map was cached
+        will not be found.
+
         Returns a list of dict objects for each result.
 
         '''
@@ -1014,14 +1203,52 @@ class _vmomiCollect( object ):
             return self._get_obj_props_nofilter( vimtype, props, root, recursive, ignoreInvalidProps )
 
         # First get the subset of managed objects we want
-        props   = propList( props )
-        filters = props.filters()
+        props     = propList( props )
+        filters   = props.filters()
+        propnames = props.names()
+        have      = None
+        if singlePass is None:
+            singlePass = ( isinstance( root, list )
+                           and len( root ) < self.single_pass_max_objects )
         if filters:
-            filterprops = tuple( filters.keys() )
+            # In a single pass, collect every requested property along with
+            # the filter properties and discard the non-matching objects
+            # locally.  This saves a round trip at the cost of transferring
+            # the extra properties for objects which are not wanted.
+            singlePass = singlePass and not ignoreInvalidProps
+            if singlePass:
+                filterprops = propnames
+            else:
+                filterprops = tuple( filters.keys() )
             # Don't skip invalid properties here even if requested since
             # these particular ones have match conditions attached.
-            res = self._get_obj_props_nofilter( vimtype, filterprops, root, recursive )
+            if ( nameCache and list( filters ) == [ 'name' ]
+                 and not singlePass and recursive
+                 and ( root is None or isinstance( root, vim.ManagedEntity ))):
+                # The caller asked for selection by name alone to be answered
+                # from the cached name map rather than another scan of the
+                # whole container; this is never done by default.
+                res = self._name_map_props( vimtype, filters[ 'name' ], root )
+            else:
+                res = self._get_obj_props_nofilter( vimtype, filterprops, root, recursive )
             match = []
+            match_append = match.append
+
+            # Convert the wanted values to sets once, so that membership
+            # tests below are constant time per property.  Values which
+            # are not hashable are left as lists.
+            wanted = {}
+            for name, vals in filters.items():
+                try:
+                    wanted[ name ] = set( vals )
+                except TypeError:
+                    wanted[ name ] = vals
+
+            def wantedp( rprop ):
+                try:
+                    return rprop.val in wanted[ rprop.name ]
+                except TypeError: # unhashable property value
+                    return rprop.val in filters[ rprop.name ]
 
             # By default, only include results for which every property name
             # has a value included in the list of wanted values for that property.
@@ -1030,15 +1257,15 @@ class _vmomiCollect( object ):
             if mustMatchAll:
                 for r in res:
                     for rprop in r.propSet:
-                        if rprop.val not in filters.get( rprop.name ):
+                        if rprop.name in wanted and not wantedp( rprop ):
                             break
                     else: # loop did not call break
-                        match.append( r )
+                        match_append( r )
             else:
                 for r in res:
                     for rprop in r.propSet:
-                        if rprop.val in filters.get( rprop.name ):
-                            match.append( r )
+                        if rprop.name in wanted and wantedp( rprop ):
+                            match_append( r )
                             break
             timer.report()
             if not match:
@@ -1051,22 +1278,71 @@ class _vmomiCollect( object ):
 
         # Now get all the props from the selected objects... if there are
         # any we don't already have.  (propnames is a superset of filters)
-        #
-        # TODO: don't refetch any properties we already have.  Strip them
-        # out, then merge this new set with the prior ones.
-        propnames = props.names()
-        if len( filters ) != len( propnames ):
+        # The filter properties already retrieved are merged back in below.
+        rest = [ name for name in propnames if name not in filters ]
+        if not filters:
             res = self._get_obj_props_nofilter( vimtype, propnames, match, recursive, ignoreInvalidProps )
+        elif rest and not singlePass:
+            res  = self._get_obj_props_nofilter( vimtype, rest, match, recursive, ignoreInvalidProps )
+            have = { r.obj : r.propSet for r in match }
         else:
             res = match
 
         if res:
-            result = []
-            for r in res:
-                elt = propset_to_dict( r.propSet )
-                elt[ 'obj' ] = r.obj
-                result.append( elt )
-            return result
+            # The obj keyword is applied last, so it wins over any
+            # property of the same name, as 'obj' always has.
+            if have:
+                return [ dict( map( _name_val, chain( r.propSet, have.get( r.obj, () ))),
+                               obj=r.obj )
+                         for r in res ]
+            return [ dict( map( _name_val, r.propSet ), obj=r.obj ) for r in res ]
+
+    def get_obj_props_multi( self, typeprops, root=None, recursive=True ):
+        '''
+        Collect a different set of properties for each of several managed
+        object types, in a single request to the server.
+
+        TYPEPROPS is a dict mapping managed object types to a list of
+        property names for that type.  Filters are not supported.
+
+        Returns a dict mapping each type to a list of dict objects for the
+        results of that type, as from get_obj_props.
+        '''
+        vimtype = list( typeprops )
+        vpc     = vmodl.query.PropertyCollector
+        result  = { vimt : [] for vimt in vimtype }
+
+        for retry in ( True, False ):
+            container, gc_container = self._get_container( vimtype, root, recursive )
+            try:
+                filterSpec = self.create_filter_spec( vimtype, container, None )
+                filterSpec.propSet = [ vpc.PropertySpec( type    = vimt,
+                                                         pathSet = propList( typeprops[ vimt ] ).names(),
+                                                         all     = False )
+                                       for vimt in vimtype ]
+
+                timer = Timer( lambda: 'retrieve multi {} '.format( ', '.join( v._wsdlName for v in vimtype )))
+                res   = list( self.retrieve_properties( filterSpec ))
+                timer.report()
+                break
+            except vmodl.fault.ManagedObjectNotFound:
+                # See _get_obj_props_nofilter
+                if not ( retry and self._forget_view( container )):
+                    raise
+            finally:
+                if gc_container:
+                    container.Destroy()
+
+        for r in res:
+            objtype = type( r.obj )
+            if objtype not in result:
+                # subclass of a requested type, e.g. ClusterComputeResource
+                for vimt in vimtype:
+                    if isinstance( r.obj, vimt ):
+                        objtype = vimt
+                        break
+            result[ objtype ].append( dict( map( _name_val, r.propSet ), obj=r.obj ))
+        return result
 
     def get_pseudo_obj( self, *args, **kwargs ):
         '''Like 'get_obj_props', but instead of returning an array of dicts with
@@ -1129,7 +1405,7 @@ class _vmomiFind( object ):
     def name_to_mo_map( self, typelist, root=None ):
         if root is None:
             root = self.si_content.rootFolder
-        typestr  = str.join( ', ', sorted( [elt.__name__ for elt in typelist] ))
+        typestr  = ', '.join( sorted( [elt.__name__ for elt in typelist] ))
         map_name = 'name to mo map: type=[{}] root={}'.format( typestr, root._moId )
         try:
             return self.cache[ map_name ]
@@ -1147,6 +1423,49 @@ class _vmomiFind( object ):
         self.cache[ map_name ] = result
         return result
 
+    def _guest_address_maps( self, root=None ):
+        '''
+        Return a pair of maps from guest ip address and guest hostname to
+        lists of VirtualMachine objects, as reported by vmware tools.
+        '''
+        if root is None:
+            root = self.si_content.rootFolder
+        map_name = 'guest address maps: root={}'.format( root._moId )
+        try:
+            return self.cache[ map_name ]
+        except KeyError:
+            pass
+
+        by_ip   = {}
+        by_host = {}
+        props   = [ 'guest.hostName', 'guest.ipAddress', 'guest.net' ]
+        mo_list = self._get_obj_props_nofilter( [vim.VirtualMachine], props, root=root )
+        for mo in mo_list:
+            guest = propset_to_dict( mo )
+            addrs = { guest.get( 'guest.ipAddress' ) }
+            for nic in guest.get( 'guest.net' ) or ():
+                addrs.update( nic.ipAddress or () )
+            addrs.discard( None )
+            for addr in addrs:
+                by_ip.setdefault( addr, [] ).append( mo.obj )
+            host = guest.get( 'guest.hostName' )
+            if host:
+                by_host.setdefault( host, [] ).append( mo.obj )
+        result = self.cache[ map_name ] = ( by_ip, by_host )
+        return result
+
+    def _name_map_props( self, typelist, names, root=None ):
+        '''
+        Return ObjectContent results with just the name property for objects
+        with any of NAMES, from name_to_mo_map.  get_obj_props only uses
+        this when the caller passes `nameCache=True'.
+        '''
+        vpc     = vmodl.query.PropertyCollector
+        mapping = self.name_to_mo_map( typelist, root )
+        return [ vpc.ObjectContent( obj=obj, propSet=[ vmodl.DynamicProperty( name='name', val=name ) ] )
+                 for name in dict.fromkeys( names ) # unique, in order
+                 for obj  in mapping.get( name, () ) ]
+
     def _get_single( self, name, mot, label, root=None ):
         '''If name is null but there is only one object of that type anyway, just return that.'''
         def err( exception, msg, res=root ):
@@ -1179,7 +1498,10 @@ class _vmomiFind( object ):
 
         if name:
             if isinstance( root, vim.ManagedObject.Array ):
-                found = [ o for o in root if o.name == name ]
+                # Fetch all the names in one query; reading o.name would
+                # be a round trip to the server for each object.
+                res   = self._get_obj_props_nofilter( mot, ['name'], root=list( root ))
+                found = [ r.obj for r in res if propset_get( r, 'name' ) == name ]
             else:
                 try:
                     found = self.name_to_mo_map( mot, root )[ name ]
@@ -1209,7 +1531,7 @@ class _vmomiFind( object ):
                     # If there is just one other resource pool other than those kind, return that.
                     childpools = [ elt for elt in found
                                    if isinstance( elt.parent, vim.ResourcePool ) ]
-                    if childpools and len( childpools ) == 1:
+                    if len( childpools ) == 1:
                         return childpools[0]
 
                 err( NameNotUniqueError,
@@ -1259,6 +1581,13 @@ class _vmomiFind( object ):
             else:
                 return search[0]
 
+    # Maximum number of names find_vm searches for at once.
+    find_vm_max_workers = 8
+
+    # Number of names find_vm must look up by guest address before it
+    # fetches the guest addresses of every vm at once.
+    guest_map_min_names = 20
+
     def find_vm( self, *names, **kwargs ):
         args = None # make copy of names since we alter
         if type( names[0] ) is not str:
@@ -1289,30 +1618,67 @@ class _vmomiFind( object ):
                 return set( self.find_vm( res, noresolv=True, showerrors=False ))
 
         idx = self.si_content.searchIndex
-        searchfns = [
+        # For a long list of names not found by name, collect the guest ip
+        # addresses and hostnames of every vm in one query rather than
+        # making FindAllByIp and FindAllByDnsName calls for each of them.
+        # For a few names the indexed searches are much cheaper.
+        unresolved = [ name for name in args if name not in vm_map ]
+        if len( unresolved ) >= self.guest_map_min_names:
+            by_ip, by_host = self._guest_address_maps( root )
+            find_by_ip     = by_ip.get
+            find_by_host   = by_host.get
+        else:
+            find_by_ip   = lambda pat: idx.FindAllByIp(      vmSearch=True,      ip=pat )
+            find_by_host = lambda pat: idx.FindAllByDnsName( vmSearch=True, dnsName=pat )
+
+        # These only use the search index or maps built above, so they
+        # are safe to run for several names at once.
+        indexfns = [
             lambda pat: idx.FindAllByUuid(    vmSearch=True,    uuid=pat, instanceUuid=True ),
             lambda pat: idx.FindAllByUuid(    vmSearch=True,    uuid=pat ),
-            lambda pat: idx.FindAllByIp(      vmSearch=True,      ip=pat ),
-            lambda pat: find_by_name( pat ),
-            # n.b. FindAllByDnsName searches vm.guest.hostName, not dns lookup
-            lambda pat: idx.FindAllByDnsName( vmSearch=True, dnsName=pat ),
+            lambda pat: find_by_ip( pat ),
+            # n.b. this is vm.guest.hostName, not dns lookup
+            lambda pat: find_by_host( pat ),
+        ]
+        # These create views or call find_vm again, so they are only
+        # tried one name at a time, after the searches above.
+        scanfns = [
             lambda pat: self.search_by_name( pat ),
             lambda pat: find_by_dns( pat ),
         ]
 
-        found    = []
-        notfound = []
-        for name in args:
+        def search( name, searchfns ):
             for fn in searchfns:
                 try:
                     res = fn( name )
                     if res:
-                        found.extend( res )
-                        break
+                        return res
                 except vmodl.fault.SystemError:
                     # ESXi 4.x doesn't like uuid searches with
                     # non-conforming patterns
                     pass
+
+        results = [ find_by_name( name ) for name in args ]
+
+        # Each remaining name may take several round trips to the server,
+        # all independent of the other names, so look them up concurrently.
+        pending = list( dict.fromkeys( unresolved ))
+        if len( pending ) > 1:
+            workers = min( len( pending ), self.find_vm_max_workers )
+            with concurrent.futures.ThreadPoolExecutor( workers ) as pool:
+                indexed = dict( zip( pending,
+                                     pool.map( search, pending,
+                                               [ indexfns ] * len( pending ))))
+        else:
+            indexed = { name : search( name, indexfns ) for name in pending }
+        results = [ res or indexed[ name ] or search( name, scanfns )
+                    for name, res in zip( args, results ) ]
+
+        found    = []
+        notfound = []
+        for name, res in zip( args, results ):
+            if res:
+                found.extend( res )
             else:
                 notfound.append( name )
 
@@ -1385,44 +1751,32 @@ class _vmomiFolderMap( object ):
                                        ['name', 'parent'] ):
             obj = elt[ 'obj' ]
             mtbl[ obj ] = [ elt[ 'name' ], elt[ 'parent' ] ]
-        p2f = {}
         f2p = {}
         for obj in mtbl:
-            name = []
-            start_obj = obj
-            while obj in mtbl:
-                node = mtbl[ obj ]
-                name.insert( 0, node[ 0 ] )
-                obj = node[ 1 ]
-                # See if we've already computed the rest of the parent path.
-                # If so, prepend it and stop.
-                try:
-                    name.insert( 0, f2p[ obj ] )
-                    break
-                except KeyError:
-                    pass
-            if name:
-                if name[0][0] != '/':
-                    name.insert( 0, '' )
-                name = str.join( '/', name )
-                p2f[ name ]      = start_obj
-                f2p[ start_obj ] = name
+            # Walk up the parents until we reach one whose path is already
+            # known (or the top of the tree), then compute the paths of
+            # every folder along the way on the way back down.  That way
+            # each folder's path is only computed once.
+            ancestry = []
+            while obj in mtbl and obj not in f2p:
+                ancestry.append( obj )
+                obj = mtbl[ obj ][ 1 ]
+            path = f2p.get( obj, '' )
+            for elt in reversed( ancestry ):
+                path = f2p[ elt ] = path + '/' + mtbl[ elt ][ 0 ]
+        p2f = inverted_dict( f2p )
         self.cache[ 'path_to_folder_map' ] = p2f
         self.cache[ 'folder_to_path_map' ] = f2p
 
     def _folder_path_map( self, attr, item=Undef ):
-        try:
-            mapping = self.cache[ attr ]
-        except KeyError:
+        mapping = self.cache.get( attr )
+        if mapping is None:
             self._init_folder_path_maps()
             mapping = self.cache[ attr ]
         if item is Undef:
             return mapping
         else:
-            try:
-                return mapping[ item ]
-            except KeyError:
-                pass
+            return mapping.get( item )
 
     def folder_to_path_map( self, item=Undef ):
         return self._folder_path_map( 'folder_to_path_map', item )
@@ -1466,27 +1820,33 @@ class _vmomiFolderMap( object ):
 ##
 
 class _vmomiNetworkMap( object ):
+    # The map is kept in the connection's cache, so it is never shared
+    # between servers and expires with the cache ttl.
     def _get_network_moId_label_map( self ):
-        try:
-            return self.cache[ 'network_moId_label_map' ]
-        except KeyError:
+        mapping = self.cache.get( 'network_moId_label_map' )
+        if mapping is None:
             nets = self._get_obj_props_nofilter( [vim.Network], ['name'] )
             mapping = {  x.obj._moId : x.propSet[ 0 ].val for x in nets }
             self.cache[ 'network_moId_label_map' ] = mapping
-            return mapping
+        return mapping
 
-    def get_nic_network_label( self, nic ):
-        try:
-            return nic.backing.deviceName
-        except AttributeError:
-            pass
+    def invalidate_network_label_map( self ):
+        '''Forget cached network names, e.g. after portgroups change.'''
+        del self.cache[ 'network_moId_label_map' ]
 
-        try:
-            groupKey = nic.backing.port.portgroupKey
-        except AttributeError:
+    def get_nic_network_label( self, nic ):
+        # Standard network backings name the network directly;
+        # distributed portgroup backings only have the portgroup key.
+        backing = nic.backing
+        label   = getattr( backing, 'deviceName', Undef )
+        if label is not Undef:
+            return label
+
+        port     = getattr( backing, 'port', None )
+        groupKey = getattr( port, 'portgroupKey', None )
+        if groupKey is None:
             return
-        mapping = self._get_network_moId_label_map()
-        return mapping.get( groupKey, groupKey )
+        return self._get_network_moId_label_map().get( groupKey, groupKey )
 
     def get_portgroup_switchUUID( self, label, host=None ):
         if not host:
@@ -1622,6 +1982,9 @@ class _vmomiChangeSpec( object ):
 ##
 
 class _vmomiGuestInfo( object ):
+    # Guest routes not worth reporting: multicast and link-local networks.
+    _skip_route_nets = frozenset(( 'ff00::', '169.254.0.0' ))
+
     def vmguest_dns_config( self, vm ):
         dns = []
         for ipStack in vm.guest.ipStack:
@@ -1637,10 +2000,8 @@ class _vmomiGuestInfo( object ):
             if elt[ 'domain' ] and elt[ 'domain' ][-1] == '.':
                 elt[ 'domain' ] = elt[ 'domain' ][:-1]
 
-            search = elt[ 'search' ]
-            for i in range( 0, len( search )):
-                if len( search[i] ) > 0 and search[ i ][ -1 ] == '.':
-                    search[ i ] = search[ i ][:-1]
+            elt[ 'search' ] = [ d[:-1] if d.endswith( '.' ) else d
+                                for d in elt[ 'search' ] ]
 
             dns.append( elt )
         return dns
@@ -1659,8 +2020,8 @@ class _vmomiGuestInfo( object ):
             routes = ipStack.ipRouteConfig.ipRoute
             for elt in routes:
                 if ( elt.prefixLength == 128
-                     or elt.network in ['ff00::', '169.254.0.0']
-                     or elt.network.find( 'fe80::' ) == 0 ):
+                     or elt.network in self._skip_route_nets
+                     or elt.network.startswith( 'fe80::' ) ):
                     continue
 
                 if elt.prefixLength != 0:
@@ -1676,11 +2037,7 @@ class _vmomiGuestInfo( object ):
                     new[ 'gateway' ] = gw
 
                 dev = int( elt.gateway.device )
-                try:
-                    eth = tbl[ dev ]
-                except KeyError:
-                    eth = tbl[ dev ] = []
-                eth.append( new )
+                tbl.setdefault( dev, [] ).append( new )
         return [ tbl.get( n, [] ) for n in nicOrder ]
 
     def vmguest_ip_addrs( self, vm ):
@@ -1703,9 +2060,52 @@ class _vmomiGuestInfo( object ):
         else:
             return vmnic.ipAddress
 
+    # Properties used by the vmguest_* methods, collected by vmguest_bulk_info.
+    vmguest_props = [ 'name',
+                      'config.hardware.device',
+                      'guest.ipStack',
+                      'guest.net',
+                      'summary.runtime.powerState', ]
+
+    def vmguest_bulk_info( self, vmlist ):
+        '''
+        Collect the properties needed by the vmguest_* methods for every vm
+        in VMLIST with a single property collector query.
+
+        Each managed object property access is a separate round trip to
+        the server, so pass the values of this to vmguest_nic_info,
+        vmguest_ip_routes, etc. instead of the vms themselves when
+        examining more than a couple of them.
+
+        Returns a dict mapping each vm to a pseudoPropAttr of its
+        properties.  Vms the server didn't return are absent.
+        '''
+        res = self.get_obj_props( [vim.VirtualMachine], self.vmguest_props,
+                                  root=list( vmlist ))
+        return { elt[ 'obj' ] : pseudoPropAttr( elt ) for elt in res or [] }
+
     def vmguest_nic_info( self, vm ):
+        '''
+        If VM is a list of vms, return a list with the result for each one
+        in the same order, collecting their properties in bulk.  The entry
+        is None for any vm whose properties could not be retrieved.
+        '''
+        if isinstance( vm, list ):
+            info = self.vmguest_bulk_info( vm )
+            return [ self.vmguest_nic_info( info[ elt ] ) if elt in info else None
+                     for elt in vm ]
+
         pst      = vim.VirtualMachine.PowerState
         ethernet = vim.vm.device.VirtualEthernetCard
+        gnics    = {}
+        if vm.summary.runtime.powerState == pst.poweredOn:
+            try:
+                gnet = vm.guest.net or []
+            except AttributeError: # not collected, e.g. no vmware tools
+                gnet = []
+            for g in reversed( gnet ): # keep first match for each mac
+                if g.macAddress:
+                    gnics[ g.macAddress.lower() ] = g
         nics = []
         for nic in get_seq_type( vm.config.hardware.device, ethernet ):
             prop = { 'obj'        : nic,
@@ -1714,11 +2114,9 @@ class _vmomiGuestInfo( object ):
                      'netlabel'   : self.get_nic_network_label( nic ),
                      'macAddress' : nic.macAddress,
                      'backing'    : nic.backing, }
-            if vm.summary.runtime.powerState == pst.poweredOn:
-                gnic = [ g for g in vm.guest.net
-                         if g.macAddress.lower() == nic.macAddress.lower() ]
-                if gnic:
-                    prop[ 'ip' ] = self.vmnic_cidrs( gnic[0] )
+            gnic = gnics.get( nic.macAddress.lower() )
+            if gnic:
+                prop[ 'ip' ] = self.vmnic_cidrs( gnic )
             nics.append( prop )
         return nics
 
@@ -1787,14 +2185,20 @@ class _vmomiGuestInfo( object ):
 ##
 
 class _vmomiMonitor( object ):
+    # Upper bound on how long a single WaitForUpdatesEx call blocks on the
+    # server.  Without it the call can block indefinitely, which keeps
+    # keyboard interrupts from being handled and can trip proxy timeouts.
+    wait_max_seconds = 30
+
     # This method will keep running until the callback returns any value other than 'None',
     # or an exception occurs (including any unhandled exception in the callback).
     # Otherwise the return value is the final return value of the callback.
     def monitor_property_changes( self, objlist, proplist, callback ):
         spc = self.si_content.propertyCollector
         vpc = vmodl.query.PropertyCollector
+        opt = vpc.WaitOptions( maxWaitSeconds=self.wait_max_seconds )
 
-        types = set( type( obj ) for obj in objlist )
+        types = { type( obj ) for obj in objlist }
         if isinstance( objlist, ( vim.view.ListView, vim.view.ContainerView )):
             container    = objlist
             gc_container = False
@@ -1811,7 +2215,9 @@ class _vmomiMonitor( object ):
 
             result, version  = None, None
             while result is None:
-                update = spc.WaitForUpdatesEx( version )
+                update = spc.WaitForUpdatesEx( version, opt )
+                if update is None: # timed out with no changes
+                    continue
                 for filterSet in update.filterSet:
                     for objSet in filterSet.objectSet:
                         for change in objSet.changeSet:
@@ -1861,14 +2267,57 @@ class vmomiConnect( _vmomiCollect,
         # When idle is negative, no timeout is enabled.
         # The default is (last I checked) 900s.
         self.idle   = int( kwargs.get( 'idle', pyVconnect.CONNECTION_POOL_IDLE_TIMEOUT_SEC ))
+        # Number of idle https connections kept open for reuse, so that
+        # concurrent or back-to-back calls don't each need a TLS handshake.
+        self.pool_size = int( kwargs.get( 'poolSize', 16 ))
         self.kwargs = kwargs
         self.cache  = Cache( ttl=kwargs.get( 'cacheTimeout', None ) )
-        self.connect()
+        # Reuse container views across queries rather than creating and
+        # destroying one per query.
+        self.reuse_views  = bool( kwargs.get( 'reuseViews', reuse_views ))
+        self._views       = {}
+        self._filterspecs = {}
+        # With lazyConnect, defer logging in until the service instance
+        # is first used.
+        if not kwargs.get( 'lazyConnect', False ):
+            self.connect()
+
+    def __getattr__( self, name ):
+        # Only called when the attribute is not already set.
+        if name in ( 'si', 'si_content' ):
+            self.connect()
+            return self.__dict__[ name ]
+        raise AttributeError( name )
 
     def __del__( self ):
         self.close()
 
+    @classmethod
+    def connect_many( cls, *configs, **kwargs ):
+        '''
+        Connect to several servers concurrently.
+        Each element of CONFIGS is an argparse.Namespace or a dict of
+        keyword args for the constructor; additional keyword args are
+        common to all of them.
+        Returns a list of connections in the same order.
+        '''
+        def conn( config ):
+            if isinstance( config, argparse.Namespace ):
+                return cls( config, **kwargs )
+            args = dict( kwargs )
+            args.update( config )
+            return cls( **args )
+
+        with concurrent.futures.ThreadPoolExecutor( max_workers=len( configs ) or 1 ) as pool:
+            return list( pool.map( conn, configs ))
+
     def close( self ):
+        if 'si' not in self.__dict__:
+            return # never connected
+        try:
+            self.invalidate_views()
+        except:
+            pass
         try:
             pyVconnect.Disconnect( self.si )
             del self.si_content
@@ -1879,15 +2328,13 @@ class vmomiConnect( _vmomiCollect,
     def connect( self ):
         timer = Timer( 'vmomiConnect.connect' )
         try:
-            try:
-                sslContext = ssl._create_unverified_context()
-            except AttributeError:
-                sslContext = None
+            sslContext = _ssl_context()
 
             # These stubs enable automatic reconnection if a session times out.
             smart_stub = pyVconnect.SmartStubAdapter(
                                  host = self.host,
                                  port = self.port,
+                             poolSize = self.pool_size,
                 connectionPoolTimeout = self.idle,
                            sslContext = sslContext )
             vsos = pyVconnect.VimSessionOrientedStub
@@ -1908,6 +2355,7 @@ class vmomiConnect( _vmomiCollect,
                         port = self.port,
                         user = self.user,
                         pwd  = self.pwd,
+                        connectionPoolTimeout = self.idle,
                         sslContext=sslContext )
                 self.si_content = self.si.content
 
@@ -1946,26 +2394,13 @@ class vmomiMKS( object ):
 
         self.host = vsi.host
         self.port = int( vsi.port )
-
-        vc_cert   = ssl.get_server_certificate( (self.host, self.port) )
-        vc_pem    = OpenSSL.crypto.load_certificate( OpenSSL.crypto.FILETYPE_PEM, vc_cert )
         content   = vsi.si_content
 
-        self.fingerprint = vc_pem.digest( 'sha1' )
-        self.serverGUID  = content.about.instanceUuid
+        self.fingerprint = self._server_fingerprint( vsi )
+        self.serverGUID  = self._server_guid( vsi )
+        self.fqdn        = self._server_fqdn( vsi )
         self.session     = content.sessionManager.AcquireCloneTicket()
 
-        # This is a dumb thing to fault on, but overly restrictive
-        # permissions might prevent us from inspecting vcenter to form a
-        # preferred url.
-        try:
-            self.fqdn = attr_get( content.setting.setting, 'VirtualCenter.FQDN' )
-        except vmodl.fault.SecurityError:
-            self.fqdn = None
-        # Might be None for an esxi session
-        if not self.fqdn:
-            self.fqdn = self.host
-
         for arg in kwargs:
             setattr( self, arg, kwargs[ arg ] )
 
@@ -1975,6 +2410,52 @@ class vmomiMKS( object ):
             self.vm_id   = str( vm._moId )
 
 
+    # These do not change for the life of a session.
+    # Fetching the certificate costs a separate TLS handshake, so only do
+    # that once per connection no matter how many consoles are opened.
+    @staticmethod
+    def _server_fingerprint( vsi ):
+        try:
+            return vsi.cache[ 'mks fingerprint' ]
+        except KeyError:
+            pass
+
+        import OpenSSL # only needed here, and slow to load
+        vc_cert = ssl.get_server_certificate( ( vsi.host, int( vsi.port )) )
+        vc_pem  = OpenSSL.crypto.load_certificate( OpenSSL.crypto.FILETYPE_PEM, vc_cert )
+        fingerprint = vc_pem.digest( 'sha1' )
+        vsi.cache[ 'mks fingerprint' ] = fingerprint
+        return fingerprint
+
+    @staticmethod
+    def _server_guid( vsi ):
+        try:
+            return vsi.cache[ 'mks serverGUID' ]
+        except KeyError:
+            guid = vsi.si_content.about.instanceUuid
+            vsi.cache[ 'mks serverGUID' ] = guid
+            return guid
+
+    @staticmethod
+    def _server_fqdn( vsi ):
+        try:
+            return vsi.cache[ 'mks fqdn' ]
+        except KeyError:
+            pass
+
+        # This is a dumb thing to fault on, but overly restrictive
+        # permissions might prevent us from inspecting vcenter to form a
+        # preferred url.
+        try:
+            fqdn = attr_get( vsi.si_content.setting.setting, 'VirtualCenter.FQDN' )
+        except vmodl.fault.SecurityError:
+            fqdn = None
+        # Might be None for an esxi session
+        if not fqdn:
+            fqdn = vsi.host
+        vsi.cache[ 'mks fqdn' ] = fqdn
+        return fqdn
+
     def uri_vmrc( self, vm=None ):
         param = dict( vars( self ))
         if vm:
@@ -2048,7 +2529,7 @@ class vmomiDataStoreFile( _with ):
         try:
             return self._session
         except AttributeError:
-            sess = self._session = requests.Session()
+            sess = self._session = _requests().Session()
             sess.stream = True
             sess.verify = False
             sess.headers.update( {
@@ -2147,16 +2628,30 @@ class vmomiDataStoreFile( _with ):
 ######
 
 class _vmomiVmGuestOperation_Env( object ):
+    # The environment is kept in the connection cache rather than on the
+    # instance, since callers often create a new guest operation object
+    # per command against the same vm and user.
+    def _guest_environ_key( self ):
+        return ('guest_environ', self.vm._moId, self.auth.username)
+
+    # With skip_env, the guest environment is never read and
+    # guest_environ is always empty.
     @tidy_vimfaults
     def guest_environ( self ):
-        try:
-            return self._guest_environ
-        except AttributeError:
+        if self.skip_env:
+            return {}
+        key = self._guest_environ_key()
+        env = self.vsi.cache.get( key )
+        if env is None:
             env = self.pmgr.ReadEnvironmentVariableInGuest(
                 vm    = self.vm,
                 auth  = self.auth )
-            self._guest_environ = environ_to_dict( env, preserve_case=False )
-            return self._guest_environ
+            env = environ_to_dict( env, preserve_case=False )
+            self.vsi.cache[ key ] = env
+        return env
+
+    def invalidate_env( self ):
+        del self.vsi.cache[ self._guest_environ_key() ]
 
     def getenv( self, name ):
         try:
@@ -2186,7 +2681,7 @@ class _vmomiVmGuestOperation_Dir( object ):
             suffix        = suffix,
             directoryPath = directoryPath )
         self._printdbg( 'mkdtemp', tmpdir )
-        self.tmpdir.append( tmpdir )
+        self.tmpdir.add( tmpdir )
         return tmpdir
 
     @tidy_vimfaults
@@ -2205,10 +2700,7 @@ class _vmomiVmGuestOperation_Dir( object ):
         else:
             self._printdbg( 'rmdir', directoryPath )
 
-        try:
-            self.tmpdir.remove( directoryPath )
-        except ValueError:
-            pass
+        self.tmpdir.discard( directoryPath )
 
         self.fmgr.DeleteDirectoryInGuest(
             vm            = self.vm,
@@ -2220,7 +2712,16 @@ class _vmomiVmGuestOperation_Dir( object ):
 
 
 class _vmomiVmGuestOperation_File( object ):
-    def _gc_tmpfiles( self, files=[], dirs=[] ):
+    def _gc_tmpfiles( self, files=[], dirs=[], timeout=None ):
+        # copy; unlink and rmdir modify self.tmpfile and self.tmpdir
+        files = list( files )
+        dirs  = list( dirs )
+        if self.ostype is POSIX and len( files ) + len( dirs ) >= self.rm_batch_min:
+            try:
+                if self._rm_batch( files + dirs, timeout ):
+                    return
+            except vim.fault.VimFault:
+                pass
         for elt in files:
             try:
                 self.unlink( elt )
@@ -2232,6 +2733,49 @@ class _vmomiVmGuestOperation_File( object ):
             except vim.fault.VimFault:
                 pass
 
+    # Fewer paths than this are deleted one call apiece; starting and
+    # polling an rm process costs more than a few DeleteFile calls.
+    rm_batch_min = 8
+    # Seconds to wait for _rm_batch's rm to finish.  __del__ uses the
+    # shorter gc timeout so garbage collection doesn't stall.
+    rm_batch_timeout    = 30
+    rm_batch_gc_timeout = 2
+
+    # Remove several paths with one rm process rather than a delete call
+    # per path.  Returns True if rm ran and exited successfully; otherwise
+    # the caller should remove the paths individually.
+    def _rm_batch( self, paths, timeout=None ):
+        self._printdbg( 'rm -rf', *paths )
+        args  = ' '.join( shlex.quote( elt ) for elt in paths )
+        pspec = vim.vm.guest.ProcessManager.ProgramSpec(
+            programPath = '/bin/rm',
+            arguments   = '-rf -- ' + args )
+        pid = self.pmgr.StartProgramInGuest(
+            vm   = self.vm,
+            auth = self.auth,
+            spec = pspec )
+
+        if timeout is None:
+            timeout = self.rm_batch_timeout
+        delay    = 0.1
+        deadline = time.monotonic() + timeout
+        while True:
+            res = self.ps( pid )
+            if not res:
+                return False # process info lost; can't tell if it worked
+            if res[0].exitCode is not None:
+                break
+            if time.monotonic() > deadline:
+                return False
+            time.sleep( delay )
+            delay = min( delay * 2, 1 )
+
+        if res[0].exitCode != 0:
+            return False
+        self.tmpfile.difference_update( paths )
+        self.tmpdir.difference_update( paths )
+        return True
+
     _fileAttrMap = { 'uid'      : 'ownerId',
                      'gid'      : 'groupId',
                      'mode'     : 'permissions',
@@ -2240,6 +2784,9 @@ class _vmomiVmGuestOperation_File( object ):
                      'ctime'    : 'createTime',
                      'hidden'   : 'hidden',
                      'readonly' : 'readOnly' }
+    _fileAttrItems = tuple( _fileAttrMap.items() )
+    _fileAttrNames = tuple( _fileAttrMap.values() )
+
     def mkFileAttributes( self, *args, **kwargs ):
         for arg in args:
             if isinstance( arg, dict ):
@@ -2252,24 +2799,32 @@ class _vmomiVmGuestOperation_File( object ):
         else:
             attr = vim.vm.guest.FileManager.PosixFileAttributes()
 
-        attrmap = self._fileAttrMap
-        for k in attrmap:
-            if kwargs.get( k ) is not None:
-                setattr( attr, attrmap[ k ], kwargs[ k ] )
+        for k, attrname in self._fileAttrItems:
+            val = kwargs.get( k )
+            if val is not None:
+                setattr( attr, attrname, val )
         return attr
 
     def decodeFileAttributes( self, attr ):
         # n.b. [acm]time are datetime objects; one way to convert
         # to unix epoch is: calendar.timegm( mtime.timetuple() )
+        #
+        # Data object properties are plain instance attributes, so read
+        # them from one snapshot of the instance dict.  None of the record
+        # keys are dotted, so they can also be stored without going
+        # through pseudoPropAttr's key path parsing.
+        props = getattr( attr, '__dict__', None )
+        if props is None:
+            props = { attrname : getattr( attr, attrname, None )
+                      for attrname in ('symlinkTarget',) + self._fileAttrNames }
         rec = pseudoPropAttr()
-        attrmap = self._fileAttrMap
-        for elt in attrmap:
-            attrname = attrmap[ elt ]
-            if getattr( attr, attrname, None ):
-                rec[ elt ] = getattr( attr, attrname )
-        symlink = getattr( attr, 'symlinkTarget', None )
+        for elt, attrname in self._fileAttrItems:
+            val = props.get( attrname )
+            if val:
+                rec._setitem( elt, val )
+        symlink = props.get( 'symlinkTarget' )
         if symlink not in ( '', None ):
-            rec[ 'symlink' ] = symlink
+            rec._setitem( 'symlink', symlink )
         return rec
 
     @tidy_vimfaults
@@ -2293,16 +2848,24 @@ class _vmomiVmGuestOperation_File( object ):
             result.extend( batch.files )
             if batch.remaining == 0:
                 break
-            index     = len( result )
-            remaining = batch.remaining
+            if max is None:
+                remaining = batch.remaining
+            else:
+                # Don't go back for the rest of the directory once we
+                # have as many entries as were asked for.
+                remaining = min( batch.remaining, max - len( result ))
+                if remaining <= 0:
+                    break
+            index += len( batch.files )
 
         if not long:
             return [ f.path for f in result ]
 
+        # n.b. long records have always come back in reverse order.
+        decode = self.decodeFileAttributes
         record = []
-        while result:
-            st  = result.pop()
-            elt = self.decodeFileAttributes( st.attributes )
+        for st in reversed( result ):
+            elt = decode( st.attributes )
             elt[ 'size' ] = st.size
             record.append( elt )
         return record
@@ -2331,39 +2894,85 @@ class _vmomiVmGuestOperation_File( object ):
             suffix        = suffix,
             directoryPath = directoryPath )
         self._printdbg( 'mktemp', tmpfile )
-        self.tmpfile.append( tmpfile )
+        self.tmpfile.add( tmpfile )
         return tmpfile
 
     @tidy_vimfaults
     def unlink( self, filePath ):
         self._printdbg( 'unlink', filePath )
-        try:
-            self.tmpfile.remove( filePath )
-        except ValueError:
-            pass
+        self.tmpfile.discard( filePath )
         self.fmgr.DeleteFileInGuest(
             vm       = self.vm,
             auth     = self.auth,
             filePath = filePath )
 
+    _xfer_bufsize = 1 << 20
+
+    # Transfers all go to the same esxi host, so keep the connection
+    # alive between them rather than doing a new tls handshake each time.
+    # A requests session is not safe to share between threads, so
+    # concurrent transfers should each use a different one; `aux' selects
+    # a second pooled session for that.
+    def _get_session( self, aux=False ):
+        attr = '_session_aux' if aux else '_session'
+        try:
+            return self.__dict__[ attr ]
+        except KeyError:
+            sess = self.__dict__[ attr ] = self._new_session()
+            return sess
+
+    @staticmethod
+    def _new_session():
+        sess = _requests().Session()
+        # TODO: verify the connection using the host cert.
+        # The urllib3 interface requires certs to be stored in a file and
+        # the location passed in, which is another annoying setup nit.
+        sess.verify = False
+        return sess
+
+    # If `out' is a writable file object, the contents are copied to it
+    # in chunks rather than returned as a string, so that large files do
+    # not have to be held in memory.
     @tidy_vimfaults
-    def get_file( self, guestFile ):
+    def get_file( self, guestFile, out=None, session=None ):
         self._printdbg( 'get_file', guestFile )
         ftinfo = self.fmgr.InitiateFileTransferFromGuest(
             vm            = self.vm,
             auth          = self.auth,
             guestFilePath = guestFile )
 
-        # TODO: verify the connection using the host cert.
-        # The urllib3 interface requires certs to be stored in a file and
-        # the location passed in, which is another annoying setup nit.
-        resp = requests.get( ftinfo.url, verify=False )
+        session = session or self._get_session()
+        resp    = session.get( ftinfo.url, stream=out is not None )
         if resp.status_code != 200:
-            raise GuestOperationError( str( status_code ), resp.reason )
-        return resp.text
+            resp.close()
+            raise GuestOperationError( str( resp.status_code ), resp.reason )
+        if out is None:
+            return resp.text
+        try:
+            for chunk in resp.iter_content( self._xfer_bufsize ):
+                out.write( chunk )
+        finally:
+            resp.close()
 
+    # `data' may be a string, bytes, or a readable file object.  A seekable
+    # binary file is streamed to the guest from its current position;
+    # anything else is read into memory first, since the transfer size
+    # must be known in bytes before it starts.
     @tidy_vimfaults
     def put_file( self, filePath, data, perm=None, overwrite=False ):
+        if ( hasattr( data, 'read' )
+             and not isinstance( data, io.TextIOBase )
+             and data.seekable() ):
+            pos  = data.tell()
+            size = data.seek( 0, os.SEEK_END ) - pos
+            data.seek( pos )
+        else:
+            if hasattr( data, 'read' ):
+                data = data.read()
+            if isinstance( data, str ):
+                data = data.encode( 'utf-8' )
+            size = len( data )
+
         attr = self.mkFileAttributes( perm )
         self._printdbg( 'put_file', filePath, attr )
         url = self.fmgr.InitiateFileTransferToGuest(
@@ -2371,11 +2980,10 @@ class _vmomiVmGuestOperation_File( object ):
             auth           = self.auth,
             guestFilePath  = filePath,
             fileAttributes = attr,
-            fileSize       = len( data ),
+            fileSize       = size,
             overwrite      = overwrite )
 
-        # TODO: verify the connection using the host cert.
-        resp = requests.put( url, data=data, verify=False )
+        resp = self._get_session().put( url, data=data )
         if resp.status_code != 200:
             raise GuestOperationError( resp )
 
@@ -2542,9 +3150,18 @@ class vmomiVmGuestOperation( _vmomiVmGuestOperation_Env,
         self.vsi     = vsi
         self.vm      = vm
 
-        self.environ = kwargs.get( 'environ' ) # optional
+        self.environ  = kwargs.get( 'environ' ) # optional
+        self.skip_env = kwargs.get( 'skip_env', False )
+
+        # Each vm attribute reference is a separate server round trip;
+        # fetch the ones needed here and in host_cert all at once.
+        props = vsi.get_obj_props( [ vim.VirtualMachine ],
+                                   [ 'name', 'config.guestId', 'runtime.host' ],
+                                   root=[ vm ] )[0]
+        self.vm_name = props[ 'name' ]
+        self.vm_host = props.get( 'runtime.host' )
 
-        if self.vm.config.guestId.find( 'win' ) == 0:
+        if (props.get( 'config.guestId' ) or '').find( 'win' ) == 0:
             self.ostype = WinNT
         else:
             self.ostype = POSIX
@@ -2563,14 +3180,20 @@ class vmomiVmGuestOperation( _vmomiVmGuestOperation_Env,
 
         # Defaults to user's homedir on linux
         self.cwd = kwargs.get( 'cwd' ) or kwargs.get( 'workingDirectory' )
-        self.tmpfile = []
-        self.tmpdir  = []
+        self.tmpfile = set()
+        self.tmpdir  = set()
 
     def __del__( self ):
         try:
-            self._gc_tmpfiles( files=self.tmpfile, dirs=self.tmpdir )
+            self._gc_tmpfiles( files=self.tmpfile, dirs=self.tmpdir,
+                               timeout=self.rm_batch_gc_timeout )
         except:
             pass
+        for sess in ( '_session', '_session_aux' ):
+            try:
+                self.__dict__[ sess ].close()
+            except:
+                pass
 
     def _printdbg( self, *text ):
         def expand( txt ):
@@ -2584,8 +3207,8 @@ class vmomiVmGuestOperation( _vmomiVmGuestOperation_Env,
                     for k in attr:
                         v = '0{:o}'.format( attr[ k ] ) if k == 'mode' \
                             else str( attr[ k ] )
-                        p.append( str.join( '=', (k, v) ))
-                    s = str.join( ', ', sorted( p ))
+                        p.append( '='.join( (k, v) ))
+                    s = ', '.join( sorted( p ))
                     result.append( s )
                 else:
                     result.append( str( elt ))
@@ -2593,20 +3216,20 @@ class vmomiVmGuestOperation( _vmomiVmGuestOperation_Env,
                 return result
 
         if debug and text:
-            text = str.join( ' ', expand( text ))
-            printerr( 'debug', self.vm.name, text )
+            text = ' '.join( expand( text ))
+            printerr( 'debug', self.vm_name, text )
 
     # Using self.vm.runtime.host.config.certificate directly would require
     # retrieving all of the properties in config first.  Using the property
     # collector retrieves just the value we want and is much faster.
     def host_cert( self ):
         vsi     = self.vsi
-        host    = self.vm.runtime.host
+        host    = self.vm_host
         vimtype = type( host )
         prop    = 'config.certificate'
         res     = vsi.get_obj_props( [ vimtype ], [ prop ], root=[ host ] )[0]
         # convert cert from byte array to string
-        return str.join( '', ( chr( c ) for c in res[ prop ] ))
+        return bytes( res[ prop ] ).decode( 'latin-1' )
 
     def run( self, *args, **kwargs):
         return vmomiVmGuestProcess( self, *args, **kwargs )
@@ -2656,9 +3279,12 @@ class vmomiVmGuestProcess( object ):
 
         self.parent  = parent
         self.cwd     = cwd or parent.cwd
+        # The environment given is passed to the guest as-is; starting a
+        # process never reads the guest's own environment.
         self.environ = environ or parent.environ
         # os.environ is not an instance of type dict, but it acts like one.
-        if hasattr( self.environ, '__getitem__' ):
+        # A list of 'name=value' strings is already in the right form.
+        if hasattr( self.environ, 'items' ):
             self.environ = dict_to_environ( self.environ )
 
         scriptperm = 0o700
@@ -2670,7 +3296,8 @@ class vmomiVmGuestProcess( object ):
         self.tmpfile = { 'script' : scriptfile }
         script += '\n'
         if parent.ostype is WinNT:
-            script.replace( '\n', '\r\n' )
+            # Normalize first so existing CRLFs don't become CRCRLF.
+            script = script.replace( '\r\n', '\n' ).replace( '\n', '\r\n' )
             scriptperm = None
             devnull    = ':NUL'
         elif script.find( '#!' ) != 0 and script.find( '\x7fELF' ) != 0:
@@ -2718,7 +3345,7 @@ class vmomiVmGuestProcess( object ):
 
         parent = self.parent
         pid    = self.pid
-        delay  = 1
+        delay  = 0.25
         while True:
             res = parent.ps( pid )
             if not res:
@@ -2729,8 +3356,9 @@ class vmomiVmGuestProcess( object ):
                 if once:
                     return
                 time.sleep( delay )
-                if delay < 10:  # increase delay up to 10s
-                    delay += 1
+                # Short scripts are noticed quickly; long ones are
+                # polled less often.  Increase delay up to 10s.
+                delay = min( delay * 2, 10 )
                 continue
 
             res = res[0]
@@ -2740,10 +3368,20 @@ class vmomiVmGuestProcess( object ):
                              'exit'      : res.exitCode })
             parent = self.parent
             parent._printdbg( 'pid', self.pid, 'exit code', res.exitCode )
-            if self.tmpfile.get( 'stdout' ):
-                result[ 'output' ] = parent.get_file( self.tmpfile[ 'stdout' ])
             if self.tmpfile.get( 'stderr' ):
-                result[ 'stderr' ] = parent.get_file( self.tmpfile[ 'stderr' ])
+                # Separate output files are independent transfers;
+                # fetch them at the same time, each on its own session.
+                outsess = parent._get_session()
+                errsess = parent._get_session( aux=True )
+                with concurrent.futures.ThreadPoolExecutor( 2 ) as pool:
+                    out = pool.submit( parent.get_file, self.tmpfile[ 'stdout' ],
+                                       session=outsess )
+                    err = pool.submit( parent.get_file, self.tmpfile[ 'stderr' ],
+                                       session=errsess )
+                    result[ 'output' ] = out.result()
+                    result[ 'stderr' ] = err.result()
+            elif self.tmpfile.get( 'stdout' ):
+                result[ 'output' ] = parent.get_file( self.tmpfile[ 'stdout' ])
             parent._gc_tmpfiles( files=self.tmpfile.values() )
             self._result = result
             return result
@@ -2766,7 +3404,7 @@ class vmomiTaskWait( object ):
 
         self.parent    = parent
         self.tasklist  = tasklist
-        self.taskleft  = [ task.info.key for task in tasklist ]
+        self.taskleft  = set( tasklist )
         self.printsucc = printsucc
 
     def diag_callback( self, err, *args ):
@@ -2784,28 +3422,37 @@ class vmomiTaskWait( object ):
                 self.diag_callback( err, change, objSet, filterSet, update )
 
         if change.name == 'info':
-            state = change.val.state
+            info  = change.val
+            state = info.state
         elif change.name == 'info.state':
+            info  = None
             state = change.val
         else:
             return
 
-        info = objSet.obj.info
-        if state == vim.TaskInfo.State.success:
-            self.taskleft.remove( info.key )
-            if self.printsucc:
-                print( info.entityName, 'Success', sep=': ' )
-        elif state == vim.TaskInfo.State.error:
-            self.taskleft.remove( info.key )
-            self.succ = 0
-            if not self.callback:
-                printerr( info.entityName, info.error.msg )
+        tstate = vim.TaskInfo.State
+        if state in ( tstate.success, tstate.error ):
+            # Only fetch the rest of the task info once it's finished.
+            if info is None:
+                info = objSet.obj.info
+            self.taskleft.discard( objSet.obj )
+            if state == tstate.success:
+                if self.printsucc:
+                    print( info.entityName, 'Success', sep=': ' )
+            else:
+                self.succ = 0
+                if not self.callback:
+                    printerr( info.entityName, info.error.msg )
 
         if not self.taskleft:
             return self.succ
 
     def wait( self ):
-        return self.parent.monitor_property_changes( self.tasklist, [], self.tw_callback )
+        # Callbacks may want progress, results, etc. so they get every
+        # change; otherwise only the state is needed to know when each
+        # task is done.
+        props = [] if self.callback else [ 'info.state' ]
+        return self.parent.monitor_property_changes( self.tasklist, props, self.tw_callback )
 
 
 
@@ -2820,34 +3467,54 @@ def _isinstance( obj, typeref ):
 
 
 def get_seq_type( obj, typeref ):
-    return [ elt for elt in obj if _isinstance( elt, typeref ) ]
+    # Callers index into the result, so this stays a list.  The test from
+    # _isinstance is inlined to avoid a function call per element.
+    NoneType = type( None )
+    return [ elt for elt in obj
+             if ( isinstance( elt, typeref )
+                  or issubclass( getattr( elt, '_vimtype', NoneType ), typeref ) ) ]
+
+_key_value     = attrgetter( 'key', 'value' )
+_name_val      = attrgetter( 'name', 'val' )
+_ObjectContent = vmodl.query.PropertyCollector.ObjectContent
 
 def attr_get( obj, name ):
-    for elt in obj:
-        if getattr( elt, 'key' ) == name:
-            return getattr( elt, 'value' )
+    for key, value in map( _key_value, obj ):
+        if key == name:
+            return value
 
 def attr_to_dict( obj, objtype=dict ):
-    return objtype( ( getattr( o, 'key' ),
-                      getattr( o, 'value' ) )
-                    for o in obj )
+    return objtype( map( _key_value, obj ))
+
+def attr_to_soa( obj ):
+    '''Return the keys and values of OBJ as two parallel tuples.
+
+    For bulk scans over many key/value arrays this avoids building a
+    throwaway dict for each one.'''
+    pairs = list( map( _key_value, obj ))
+    if not pairs:
+        return (), ()
+    keys, vals = zip( *pairs )
+    return keys, vals
 
 
 def propset_get( propset, name ):
-    try:
+    if isinstance( propset, _ObjectContent ):
         propset = propset.propSet
-    except AttributeError:
-        pass
     for elt in propset:
         if elt.name == name:
             return elt.val
 
 def propset_to_dict( propset, objtype=dict ):
-    try:
+    if isinstance( propset, _ObjectContent ):
         propset = propset.propSet
-    except AttributeError:
-        pass
-    return objtype( (p.name, p.val) for p in propset )
+    return objtype( map( _name_val, propset ))
+
+# Property paths repeat across every object in a result set, so only
+# split each distinct one once.
+@functools.lru_cache( maxsize=4096 )
+def _split_key( key, sep ):
+    return tuple( key.split( sep ))
 
 def flat_to_nested_dict( flat, sep='.', objtype=dict ):
     '''
@@ -2890,19 +3557,22 @@ def flat_to_nested_dict( flat, sep='.', objtype=dict ):
             result[ 'a' ][ 'b' ][ 'c' ] == result.a.b.c
     '''
     nested = objtype()
-    for k in flat:
-        parts = k.split( sep )
+    for k, v in flat.items():
+        if sep not in k:
+            nested[ k ] = v
+            continue
+        parts = _split_key( k, sep )
         walk = nested
         for elt in parts[ 0 : -1 ]: # all but last
-            try:
-                if not isinstance( walk[ elt ], objtype ):
-                    prev_elt = walk[ elt ]
-                    walk[ elt ] = objtype()
-                    walk[ elt ][ None ] = prev_elt
-            except KeyError:
+            sub = walk.get( elt, Undef )
+            if sub is Undef:
+                sub = walk[ elt ] = objtype()
+            elif not isinstance( sub, objtype ):
                 walk[ elt ] = objtype()
-            walk = walk[ elt ]
-        walk[ parts[ -1 ] ] = flat[ k ]
+                walk[ elt ][ None ] = sub
+                sub = walk[ elt ]
+            walk = sub
+        walk[ parts[ -1 ] ] = v
     return nested
 
 def environ_to_dict( names, preserve_case=False ):
@@ -2916,7 +3586,7 @@ def environ_to_dict( names, preserve_case=False ):
     return res
 
 def dict_to_environ( names ):
-    return sorted( str.join( '=', (k, names[ k ])) for k in names )
+    return sorted( map( '='.join, names.items() ))
 
 # n.b. this only works if values are hashable, and may lose elements if not 1:1
 def inverted_dict( d ):
@@ -2965,37 +3635,44 @@ def dns_lookup( arg, errors=False ):
             ans[ 'inet6' ].append( sockaddr[0] )
     return ans
 
-# This doesn't just use the textwrap class because we can do a few special
-# things here, such as avoiding filling command examples
-def fold_text( text, maxlen=75, indent=0 ):
-    text = text.expandtabs( 8 )
+# Patterns used by fold_text, compiled once.
+_fold_re_unfill = re.compile( r'(?<=\S{42})\s*\n\s*', flags=re.M )
 
-    text      = re.sub( '\r', '', text )             # CRLF -> LF
-    paragraph = re.split( '\n\n', text, flags=re.M ) # Split into separate chunks.
+@functools.lru_cache( maxsize=16 )
+def _fold_re_ll( maxlen ):
+    return re.compile( r'(.{1,%s})(?:\s+|$)' % maxlen, flags=re.M )
 
-    re_ll = re.compile( '(.{1,%s})(?:\s+|$)' % maxlen, flags=re.M )
-    filled = []
-    for para in paragraph:
-        if re.match( '^\s*[#$]', para ):
-            filled.append( para )
-            continue
+def _fold_paragraph( para, re_ll ):
+    if para.lstrip().startswith( ('#', '$') ):
+        return para
+
+    # Remove all newlines, replacing trailing/leading
+    # whitespace with a single space.
+    #para = re.sub( '\\s*\n\\s*', ' ', para, flags=re.M )
+    # Only unfill if line is >= 42 chars.  A single-line paragraph has
+    # nothing to unfill, so don't make another copy of it.
+    if '\n' in para:
+        para = _fold_re_unfill.sub( ' ', para )
 
-        # Remove all newlines, replacing trailing/leading
-        # whitespace with a single space.
-        #para = re.sub( '\\s*\n\\s*', ' ', para, flags=re.M )
-        # Only unfill if line is >= 42 chars
-        para = re.sub( '(?<=\S{42})\\s*\n\\s*', ' ', para, flags=re.M )
+    # split into lines no longer than maxlen but only at whitespace.
+    para = re_ll.sub( '\\1\n', para )
+    # but remove final newline.  (A paragraph never contains a blank
+    # line, so there are no other runs of newlines to collapse.)
+    return para.rstrip( '\n' )
 
-        # split into lines no longer than maxlen but only at whitespace.
-        para = re.sub( re_ll, '\\1\n', para )
-        # but remove final newline
-        para = re.sub( '\n+$', '', para, flags=re.M )
-        filled.append( para )
+# This doesn't just use the textwrap class because we can do a few special
+# things here, such as avoiding filling command examples
+def fold_text( text, maxlen=75, indent=0 ):
+    text = text.expandtabs( 8 )
+    text = text.replace( '\r', '' )  # CRLF -> LF
 
-    text = str.join( '\n\n', filled ) # rejoin paragraphs at the end.
+    # Split into separate chunks, fill each, and rejoin at the end.
+    re_ll = _fold_re_ll( maxlen )
+    text  = '\n\n'.join( _fold_paragraph( para, re_ll )
+                          for para in text.split( '\n\n' ))
     if indent:
         repl = '\n' + (' ' * indent)
-        text = re.sub( '\n', repl, text, flags=re.M )
+        text = text.replace( '\n', repl )
 
     return text
 
@@ -3029,6 +3706,19 @@ def scale_size( size, si=False, forceunit=None, roundp=False, fp=2, minimize=Fal
 
     fmtsize = 1000 if si else 1024
     suffix  = ('B', 'K', 'M', 'G', 'T', 'P', 'E')
+
+    # Fast path for the common case: a positive integer byte count that is
+    # an exact multiple of the binary unit it scales to.  Anything else,
+    # or anything too large to convert to float exactly, takes the general
+    # path below.
+    if type( size ) is int and 0 < size < 2**53 and not (si or forceunit):
+        idx = ( size.bit_length() - 1 ) // 10
+        if idx and ( size >> ( 10 * idx )) < 10 and not minimize:
+            idx -= 1
+        shift = 10 * idx
+        if not size & (( 1 << shift ) - 1 ):
+            unit = suffix[ idx ] + 'iB' if idx else 'B'
+            return '{} {}'.format( size >> shift, unit )
     idx     = 0
     isneg   = size < 0
     size    = abs( float( size ) )
@@ -3040,9 +3730,16 @@ def scale_size( size, si=False, forceunit=None, roundp=False, fp=2, minimize=Fal
     elif size < fmtsize:
         pass
     else:
-        while size >= fmtsize:
-            size /= fmtsize
-            idx  += 1
+        if si:
+            while size >= fmtsize:
+                size /= fmtsize
+                idx  += 1
+        else:
+            # Binary units are just the base-2 exponent in steps of 10.
+            # Scaling by a power of two is exact, so this gives the same
+            # result as dividing by 1024 repeatedly.
+            idx  = ( math.frexp( size )[ 1 ] - 1 ) // 10
+            size = math.ldexp( size, -10 * idx )
 
         if size < 10 and not minimize: # Prefer 4096M to 4G
             size *= fmtsize
@@ -3154,14 +3851,11 @@ def printmsg( *args, **kwargs ):
     prefix = []
     if timestring_format:
         prefix.append( timestring() )
-    if 'progname' in kwargs:
-        if kwargs[ 'progname' ] is not None:
-            prefix.append( kwargs[ 'progname' ] + ':' )
-        del kwargs[ 'progname' ]
-    else:
-        prefix.append( progname + ':' )
+    name = kwargs.pop( 'progname', progname )
+    if name is not None:
+        prefix.append( name + ':' )
     if prefix:
-        print( ' '.join( prefix ), '', file=fh, end='' )
+        fh.write( ' '.join( prefix ) + ' ' )
 
     print( *args, **kwargs )
     fh.flush()
@@ -3177,6 +3871,27 @@ def file_contents( filename, mode='r' ):
     with open( filename, mode ) as f:
         return f.read()
 
+
+# Code objects already compiled by this process, keyed by path, size
+# and modification time.  Nothing is written to disk: rc files can hold
+# passwords, which would end up in the code object's constants.
+_compiled_files = {}
+
+def compile_file_cached( filename ):
+    '''Compile the python source in FILENAME for exec.
+
+    The code object is reused for the rest of the process as long as the
+    file's path, size and modification time are the same.
+    '''
+    st  = os.stat( filename )
+    key = ( os.path.abspath( filename ), st.st_mtime_ns, st.st_size )
+    code = _compiled_files.get( key )
+    if code is None:
+        # Text mode reads already turn CRLF into LF.
+        script = file_contents( filename )
+        code = _compiled_files[ key ] = compile( script, filename, 'exec' )
+    return code
+
 
 def y_or_n_p( prompt, yes='y', no='n', response=None, default=None ):
     if response is None:
@@ -3192,17 +3907,19 @@ def y_or_n_p( prompt, yes='y', no='n', response=None, default=None ):
         default = True
     prompt = prompt + choice
 
+    try:
+        # Try this first, because `input' in python 2.x evals the result.
+        # In python 3.x, it replaces `raw_input' without evaling.
+        # It's easier to try raw_input than try to figure out what
+        # the semantics of `input' are directly.
+        read = raw_input
+    except NameError:
+        read = input
+
     try:
         while True:
             print( prompt, end='' )
-            try:
-                # Try this first, because `input' in python 2.x evals the result.
-                # In python 3.x, it replaces `raw_input' without evaling.
-                # It's easier to try raw_input than try to figure out what
-                # the semantics of `input' are directly.
-                ans = raw_input().lower()
-            except NameError:
-                ans = input().lower()
+            ans = read().lower()
             if ans in response:
                 return response[ans]
             elif ans == '' and default is not None: